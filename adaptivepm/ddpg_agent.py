@@ -1,3 +1,4 @@
+import copy
 from dataclasses import dataclass, field
 from typing import List, Optional, Tuple
 
@@ -14,8 +15,7 @@ from adaptivepm.dataset import (
 from adaptivepm.memory import ExperienceReplayMemory, PortfolioVectorMemory
 from adaptivepm.models import Actor, Critic
 from adaptivepm.portfolio import Portfolio
-
-torch.set_default_device("mps")
+from adaptivepm.prefetcher import Prefetcher
 
 
 @dataclass
@@ -37,11 +37,22 @@ class DDPGAgent:
     actor_optimizer: torch.optim = field(init=False)
     critic_optimizer: torch.optim = field(init=False)
     loss_fn: nn.modules.loss.MSELoss = field(init=False)
+    actor_scaler: torch.amp.GradScaler = field(init=False)
+    critic_scaler: torch.amp.GradScaler = field(init=False)
     dataloader: DataLoader = field(init=False)
     pvm: PortfolioVectorMemory = field(init=False)
     replay_memory: ExperienceReplayMemory = field(init=False)
     gamma: float = 0.99
     tau: float = 0.005
+    log_every: int = 50
+    loss_history: List[Tuple[float, float, float]] = field(
+        init=False, default_factory=list
+    )
+    _loss_buf: torch.tensor = field(init=False, repr=False)
+    _actor_params: List[nn.Parameter] = field(init=False, repr=False)
+    _critic_params: List[nn.Parameter] = field(init=False, repr=False)
+    _target_actor_params: List[nn.Parameter] = field(init=False, repr=False)
+    _target_critic_params: List[nn.Parameter] = field(init=False, repr=False)
 
     def __post_init__(self):
         kraken_ds = KrakenDataSet(self.portfolio, self.window_size, self.step_size)
@@ -53,83 +64,140 @@ class DDPGAgent:
             batch_size=1,
             batch_sampler=batch_sampler,
             pin_memory=True,
-            generator=torch.Generator(device=self.device),
+            generator=torch.Generator(),
         )
         m_noncash_assets = self.portfolio.m_noncash_assets
         self.actor = Actor(3, m_noncash_assets)
         self.critic = Critic(3, m_noncash_assets)
         self.target_actor = self.clone_network(self.actor)
         self.target_critic = self.clone_network(self.critic)
+        # parameter lists are built once and reused by the optimizers and soft updates
+        # moving the networks to the device keeps the same parameter objects
+        self._actor_params = list(self.actor.parameters())
+        self._critic_params = list(self.critic.parameters())
+        self._target_actor_params = list(self.target_actor.parameters())
+        self._target_critic_params = list(self.target_critic.parameters())
         self.actor_optimizer = torch.optim.Adam(
-            self.actor.parameters(), lr=self.learning_rate, betas=self.betas
+            self._actor_params, lr=self.learning_rate, betas=self.betas
         )
         self.critic_optimizer = torch.optim.Adam(
-            self.critic.parameters(), lr=self.learning_rate, betas=self.betas
+            self._critic_params, lr=self.learning_rate, betas=self.betas
         )
         self.actor.to(self.device)
         self.critic.to(self.device)
         self.target_actor.to(self.device)
         self.target_critic.to(self.device)
+        self.actor = self.compile_network(self.actor)
+        self.critic = self.compile_network(self.critic)
+        self.target_actor = self.compile_network(self.target_actor)
+        self.target_critic = self.compile_network(self.target_critic)
         self.loss_fn = nn.MSELoss()
+        # loss scaling guards the float16 backward pass wherever autocast is enabled
+        device_type = torch.device(self.device).type
+        use_scaler = device_type != "cpu"
+        self.actor_scaler = torch.amp.GradScaler(device_type, enabled=use_scaler)
+        self.critic_scaler = torch.amp.GradScaler(device_type, enabled=use_scaler)
         self.pvm = PortfolioVectorMemory(
-            self.portfolio.n_samples, self.portfolio.m_noncash_assets
+            self.portfolio.n_samples,
+            self.portfolio.m_noncash_assets,
+            device=self.device,
         )
-        self.replay_memory = ExperienceReplayMemory()
+        self.replay_memory = ExperienceReplayMemory(device=self.device)
+        self.portfolio.warmup(self.batch_size, self.device)
+        # on device buffer of (critic_loss, actor_loss) for every step of an epoch
+        self._loss_buf = torch.zeros(len(self.dataloader), 2, device=self.device)
         self.update_target_networks()
 
-    def clone_network(self, network):
-        cloned_network = type(network)()
-        cloned_network.load_state_dict(network.state_dict())
+    def clone_network(self, network: nn.Module) -> nn.Module:
+        """Returns a copy of the network to be used as a target network.
+        The copy is never optimized, hence its parameters do not require grad
+        """
+        cloned_network = copy.deepcopy(network)
+        cloned_network.requires_grad_(False)
+        cloned_network.eval()
         return cloned_network
 
-    def select_action(self, state):
-        """Select action using the actor's policy (deterministic action)"""
-        self.actor.eval()  # Ensure the actor is in evaluation mode
-        with torch.no_grad():
-            action = self.actor(state)
-        self.actor.train()
+    def compile_network(self, network: nn.Module) -> nn.Module:
+        """Compiles the network with torch.compile when training on cuda.
+        The inductor backend has limited support for mps, hence the network is
+        scripted there instead, as is the transaction remainder factor kernel.
+        The network is returned as is on cpu
+        """
+        device_type = torch.device(self.device).type
+        if device_type == "cuda":
+            return torch.compile(network, mode="reduce-overhead", fullgraph=False)
+        if device_type == "mps":
+            return torch.jit.script(network)
+        return network
+
+    def autocast(self) -> torch.autocast:
+        """Mixed precision context for the forward passes of the networks.
+        Parameters and losses stay in float32, autocast is disabled on cpu
+        """
+        device_type = torch.device(self.device).type
+        return torch.autocast(
+            device_type=device_type,
+            dtype=torch.float16,
+            enabled=device_type != "cpu",
+        )
+
+    def select_action(self, price_tensor: torch.tensor, prev_weights: torch.tensor):
+        """Select action using the actor's policy (deterministic action)
+        The actor has no batchnorm or dropout layers so it behaves the same in
+        train and eval mode, hence the mode is not toggled on every step
+        """
+        with torch.inference_mode():
+            action = self.actor(price_tensor, prev_weights)
         return action
 
     def update_target_networks(self):
-        self.soft_update(self.target_actor, self.actor, self.tau)
-        self.soft_update(self.target_critic, self.critic, self.tau)
+        self.soft_update(self._target_actor_params, self._actor_params, self.tau)
+        self.soft_update(self._target_critic_params, self._critic_params, self.tau)
 
+    @torch.no_grad()
     def soft_update(
-        self, target_network: nn.Module, main_network: nn.Module, tau: float
+        self,
+        target_params: List[nn.Parameter],
+        main_params: List[nn.Parameter],
+        tau: float,
     ):
-        """_summary_
+        """Polyak update of the target network parameters done in place, i.e
+        target = tau * main + (1 - tau) * target
 
         Parameters
         ----------
-        target_network : nn.Module
-            _description_
-        main_network : nn.Module
-            _description_
+        target_params : List[nn.Parameter]
+            parameters of the target network, updated in place
+        main_params : List[nn.Parameter]
+            parameters of the network that is being trained
         tau : float
-            _description_
+            interpolation factor
         """
-        for target_param, main_param in zip(
-            target_network.parameters(), main_network.parameters()
-        ):
-            target_param.data.copy_(
-                tau * main_param.data + (1.0 - tau) * target_param.data
-            )
+        torch._foreach_mul_(target_params, 1.0 - tau)
+        torch._foreach_add_(target_params, main_params, alpha=tau)
 
-    def train_actor(self, price_tensor: torch.tensor, prev_index: torch.tensor):
+    def train_actor(
+        self,
+        price_tensor: torch.tensor,
+        prev_index: torch.tensor,
+        next_index: torch.tensor,
+    ):
         previous_weights = self.pvm.get_memory_stack(prev_index)
-        state = (price_tensor, previous_weights)
-        actions = self.actor(state)
+        with self.autocast():
+            actions = self.actor(price_tensor, previous_weights)
+            q_values = self.critic(price_tensor, previous_weights, actions)
 
         # compute the actor loss using deterministic policy gradient
-        actor_loss = -self.critic(state, actions).mean()
+        actor_loss = -q_values.float().mean()
 
-        self.pvm.update_memory_stack(actions.detach(), prev_index + 1)
+        self.pvm.update_memory_stack(actions.detach(), next_index)
 
         # perform backprop
         self.actor_optimizer.zero_grad()
-        actor_loss.backward()
-        self.actor_optimizer.step()
-        return actor_loss.item()
+        self.actor_scaler.scale(actor_loss).backward()
+        self.actor_scaler.step(self.actor_optimizer)
+        self.actor_scaler.update()
+        return actor_loss.detach()
 
     def train_critic(self, state, action, reward, next_state):
         """Train the critic network by minimizing the loss based on TD Error
@@ -147,47 +215,53 @@ class DDPGAgent:
         done : function
             _description_
         """
-        # get predicted q values from current batch
-        predicted_q_values = self.critic(state, action)
+        with self.autocast():
+            # get predicted q values from current batch
+            predicted_q_values = self.critic(*state, action)
 
-        with torch.no_grad():
-            # get the next q values using the target critic and next state (from target network)
-            next_action = self.target_actor(next_state)
-            next_q_values = self.target_critic(next_state, next_action)
+            with torch.no_grad():
+                # get the next q values using the target critic and next state (from target network)
+                next_action = self.target_actor(*next_state)
+                next_q_values = self.target_critic(*next_state, next_action)
 
-            # calculate target q values using bellman equation
-            target_q_values = reward + self.gamma * next_q_values
+        # calculate target q values using bellman equation
+        target_q_values = reward + self.gamma * next_q_values.float()
 
         # compute the critic loss using MSE between predicted Q-values and target Q-values
         # Hence we are minimizing the TD Error
-        critic_loss = self.loss_fn(predicted_q_values, target_q_values)
+        critic_loss = self.loss_fn(predicted_q_values.float(), target_q_values)
         self.critic_optimizer.zero_grad()
-        critic_loss.backward()
-        self.critic_optimizer.step()
-        return critic_loss.item()
+        self.critic_scaler.scale(critic_loss).backward()
+        self.critic_scaler.step(self.critic_optimizer)
+        self.critic_scaler.update()
+        return critic_loss.detach()
 
     def train(self):
         log = ts.Report(self.n_epochs)
-        n = len(self.dataloader)
 
         for epoch in range(self.n_epochs):
+            n_steps = 0
             for idx, (xt, xt_next, prev_index) in enumerate(
-                get_current_and_next_batch(self.dataloader)
+                Prefetcher(get_current_and_next_batch(self.dataloader), self.device)
             ):
+                n_steps = idx + 1
+                next_index = prev_index + 1
                 # get the previous weights from portfolio vector memory
                 previous_action = self.pvm.get_memory_stack(prev_index)
-                state = (xt, previous_action)
 
                 # get current weight from actor network given s = (Xt, wt_prev)
-                action = self.select_action(state)
+                action = self.select_action(xt, previous_action)
                 # store the current action back into pvm
-                self.pvm.update_memory_stack(action.detach(), prev_index + 1)
+                self.pvm.update_memory_stack(action.detach(), next_index)
                 # get the relative price vector from price tensor
                 yt = 1 / xt[:, 0, :, -2]
                 reward = self.portfolio.get_reward(action, yt, previous_action)
-                next_state = (xt_next, action)
                 self.replay_memory.add(
-                    state, action, reward, next_state, self.batch_size
+                    (xt, previous_action),
+                    action,
+                    reward,
+                    (xt_next, action),
+                    self.batch_size,
                 )
                 state_batch, action_batch, reward_batch, next_state_batch = (
                     self.replay_memory.sample(self.batch_size)
@@ -198,16 +272,26 @@ class DDPGAgent:
                 )
 
                 # train the actor
-                actor_loss = self.train_actor(
-                    state_batch, action_batch, reward_batch, next_state_batch
-                )
+                actor_loss = self.train_actor(xt, prev_index, next_index)
                 self.update_target_networks()
-                pos = epoch + (1 + idx) / n
-                log.record(
-                    pos,
-                    critic_loss=critic_loss.detach(),
-                    actor_loss=actor_loss.detach(),
-                    end="\r",
-                )
+                self._loss_buf[idx, 0].copy_(critic_loss)
+                self._loss_buf[idx, 1].copy_(actor_loss)
+            if n_steps == 0:
+                continue
+            # single device to host transfer of the epoch's running losses
+            losses = self._loss_buf[:n_steps].cpu()
+            self.loss_history.extend(
+                (epoch + (1 + step) / n_steps, *losses[step].tolist())
+                for step in range(self.log_every - 1, n_steps, self.log_every)
+            )
+            critic_loss, actor_loss = losses.mean(dim=0).tolist()
+            # report_avgs(e) averages the records with e - 1 <= pos < e, so the epoch
+            # mean is recorded at a position inside [epoch, epoch + 1)
+            log.record(
+                epoch + 0.5,
+                critic_loss=critic_loss,
+                actor_loss=actor_loss,
+                end="\r",
+            )
             log.report_avgs(epoch + 1)
         log.plot_epochs(["critic_loss", "actor_loss"])
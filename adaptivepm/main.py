@@ -6,13 +6,9 @@
 
 from typing import List
 
-import torch
-
 from adaptivepm.ddpg_agent import DDPGAgent
 from adaptivepm.portfolio import Portfolio
 
-torch.set_default_device("mps")
-
 
 def main():
     BATCH_SIZE = 50  # training is done in mini-batches
@@ -1,11 +1,16 @@
-from collections import deque
 from dataclasses import dataclass, field
-from typing import Optional, Tuple
+from typing import ClassVar, Optional, Tuple
 
-import numpy as np
 import torch
 
 
+def _resolve_device(device: Optional[torch.device]) -> torch.device:
+    """returns device as a torch.device, defaulting to mps when it is available"""
+    if device is None:
+        return torch.device("mps" if torch.mps.is_available() else "cpu")
+    return torch.device(device)
+
+
 @dataclass
 class PortfolioVectorMemory:
     """Implements the Portfolio Vector Memory inspired by the idea of experience replay memory (Mnih et al., 2013),
@@ -16,61 +21,155 @@ class PortfolioVectorMemory:
     n_samples: int
     m_noncash_assets: int
     initial_weight: Optional[torch.tensor] = None
+    dtype: torch.dtype = torch.float32
+    device: Optional[torch.device] = None
     memory: torch.tensor = field(init=False)
-    device: torch.device = field(init=False)
 
     def __post_init__(self):
-        self.device = torch.device("mps" if torch.mps.is_available() else "cpu")
-        self.memory = torch.ones(self.n_samples, self.m_noncash_assets) / (
-            self.m_noncash_assets + 1
+        self.device = _resolve_device(self.device)
+        self._check_fits_in_memory()
+        self.memory = torch.ones(
+            self.n_samples, self.m_noncash_assets, device=self.device, dtype=self.dtype
+        ) / (self.m_noncash_assets + 1)
+
+    def _check_fits_in_memory(self):
+        """asserts the memory stack fits in the memory available to the device"""
+        n_bytes = self.n_samples * self.m_noncash_assets * self.dtype.itemsize
+        if self.device.type == "mps":
+            available = torch.mps.recommended_max_memory()
+        elif self.device.type == "cuda":
+            available, _ = torch.cuda.mem_get_info(self.device)
+        else:
+            return
+        assert (
+            n_bytes < available
+        ), f"portfolio vector memory needs {n_bytes} bytes, {available} available"
+
+    def _as_index(self, indices: torch.tensor) -> torch.tensor:
+        """returns indices as a long tensor on the same device as the memory"""
+        return (
+            torch.as_tensor(indices)
+            .to(self.memory.device, dtype=torch.long, non_blocking=True)
+            .contiguous()
         )
-        self.memory = self.memory.to(self.device)
 
     def update_memory_stack(self, new_weights: torch.tensor, indices: torch.tensor):
-        self.memory[indices] = new_weights
+        indices = self._as_index(indices).unsqueeze(1)
+        new_weights = new_weights.to(self.memory.dtype).contiguous()
+        self.memory.scatter_(0, indices.expand(-1, self.m_noncash_assets), new_weights)
 
     def get_memory_stack(self, indices):
-        return self.memory[indices]
+        return self.memory.index_select(0, self._as_index(indices))
 
 
 @dataclass
 class ExperienceReplayMemory:
     """Implements the Experience Replay Memory by (Mnih et al. 2013)
     c.f https://www.cs.toronto.edu/~vmnih/docs/dqn.pdf
-    by storing the experience (Xt, w(t-1), wt, rt, X(t+1), done)"""
-
-    buffer: deque = field(init=False)
+    by storing the experience (Xt, w(t-1), wt, rt, X(t+1), done)
+    Each field is kept in its own contiguous tensor store which is allocated
+    on the first call to add"""
+
+    capacity: int = 100000
+    replacement_ratio: ClassVar[int] = 100
+    device: Optional[torch.device] = None
+    states_x: torch.tensor = field(init=False, default=None)
+    states_w: torch.tensor = field(init=False, default=None)
+    actions: torch.tensor = field(init=False, default=None)
+    rewards: torch.tensor = field(init=False, default=None)
+    next_states_x: torch.tensor = field(init=False, default=None)
+    next_states_w: torch.tensor = field(init=False, default=None)
+    pos: int = field(init=False, default=0)
+    full: bool = field(init=False, default=False)
 
     def __post_init__(self):
-        self.buffer = deque(maxlen=1000000)
+        self.device = _resolve_device(self.device)
 
     def __repr__(self):
         return ""
 
     def __len__(self):
-        return len(self.buffer)
+        return self.capacity if self.full else self.pos
 
     def __getitem__(self, idx):
-        return self.buffer[idx]
+        return (
+            (self.states_x[idx], self.states_w[idx]),
+            self.actions[idx],
+            self.rewards[idx],
+            (self.next_states_x[idx], self.next_states_w[idx]),
+        )
 
-    def add(self, state, action, reward, next_state, batch_size):
-        experience = (
-            (
-                (state[0][i], state[1][i]),
-                action[i],
-                reward[i],
-                (next_state[0][i], next_state[1][i]),
+    def _allocate(self, state, action, reward, next_state):
+        """allocates the backing tensors on the device using the shapes of the
+        first experience, so that adding and sampling never cross host and device
+        """
+
+        def empty_like_store(tensor: torch.tensor) -> torch.tensor:
+            return torch.empty(
+                (self.capacity, *tensor.shape[1:]),
+                dtype=tensor.dtype,
+                device=self.device,
             )
-            for i in range(batch_size)
+
+        self.states_x = empty_like_store(state[0])
+        self.states_w = empty_like_store(state[1])
+        self.actions = empty_like_store(action)
+        self.rewards = empty_like_store(reward)
+        self.next_states_x = empty_like_store(next_state[0])
+        self.next_states_w = empty_like_store(next_state[1])
+
+    def _stores(self) -> Tuple[torch.tensor, ...]:
+        return (
+            self.states_x,
+            self.states_w,
+            self.actions,
+            self.rewards,
+            self.next_states_x,
+            self.next_states_w,
         )
-        self.buffer.extend(experience)
 
-    def sample(self, batch_size) -> Tuple[...]:
-        batch = np.random.choice(len(self.buffer), batch_size, replace=False)
-        state, action, reward, next_state = zip(*(self.buffer[i] for i in batch))
+    def add(self, state, action, reward, next_state, batch_size):
+        if self.states_x is None:
+            self._allocate(state, action, reward, next_state)
+        values = (state[0], state[1], action, reward, next_state[0], next_state[1])
+
+        # write the minibatch at the cursor, wrapping around the end of the stores
+        n_first = min(batch_size, self.capacity - self.pos)
+        n_rest = batch_size - n_first
+        for store, value in zip(self._stores(), values):
+            value = value.detach()
+            store[self.pos : self.pos + n_first].copy_(value[:n_first])
+            if n_rest:
+                store[:n_rest].copy_(value[n_first:])
+
+        if self.pos + batch_size >= self.capacity:
+            self.full = True
+        self.pos = (self.pos + batch_size) % self.capacity
+
+    def sample(self, batch_size, replace: Optional[bool] = None) -> Tuple[...]:
+        """samples a minibatch of experiences uniformly from the memory
+
+        Parameters
+        ----------
+        batch_size : int
+            number of experiences to sample
+        replace : bool, optional
+            sample with replacement, by default only once the memory holds at least
+            replacement_ratio * batch_size experiences so that collisions are
+            negligible, until then the minibatch is sampled without replacement
+        """
+        if replace is None:
+            replace = len(self) >= self.replacement_ratio * batch_size
+        if replace:
+            idx = torch.randint(0, len(self), (batch_size,), device=self.device)
+        else:
+            idx = torch.randperm(len(self), device=self.device)[:batch_size]
+        states_x, states_w, action, reward, next_states_x, next_states_w = (
+            store.index_select(0, idx) for store in self._stores()
+        )
         return (
-            state,
-            torch.stack(action),
-            torch.tensor(reward, dtype=torch.float32),
-            next_state,
+            (states_x, states_w),
+            action,
+            reward,
+            (next_states_x, next_states_w),
         )
@@ -3,8 +3,6 @@
 # Actor will estimate the policy
 # Critic will estimate the Q value function
 
-from typing import Tuple
-
 import torch
 import torch.nn as nn
 
@@ -44,7 +42,9 @@ class Actor(nn.Module):
         self.softmax = nn.Softmax(dim=2)
         self.apply(weights_init)
 
-    def forward(self, state: Tuple[torch.tensor, torch.tensor]) -> torch.tensor:
+    def forward(
+        self, price_tensor: torch.Tensor, prev_weights: torch.Tensor
+    ) -> torch.Tensor:
         """performs a forward pass and returns portfolio weights at time t
         c.f pg 14-15 from https://arxiv.org/pdf/1706.10059
 
@@ -54,7 +54,7 @@ class Actor(nn.Module):
             price tensor Xt comprised of close, high and low prices
             dim = (batch_size, kfeatures, massets, window_size)
             window_size pretains to last 50 trading prices
-        pvm : torch.tensor
+        prev_weights : torch.tensor
             weights w(t-1) from portfolio vector memory at time t-1
             dim = (batch_size, massets)
 
@@ -63,7 +63,6 @@ class Actor(nn.Module):
         torch.tensor, dim = (batch_size, m_noncash_assets)
             action or current weights at time t
         """
-        price_tensor, prev_weights = state
         batch_size = price_tensor.shape[0]
         x = self.model(price_tensor)
         prev_weights = prev_weights.unsqueeze(2).repeat(1, 1, 1).unsqueeze(1)
@@ -109,19 +108,21 @@ class Critic(nn.Module):
         self.apply(weights_init)
 
     def forward(
-        self, state: Tuple[torch.tensor, torch.tensor], current_weights: torch.tensor
-    ) -> torch.tensor:
+        self,
+        price_tensor: torch.Tensor,
+        prev_weights: torch.Tensor,
+        current_weights: torch.Tensor,
+    ) -> torch.Tensor:
         """_summary_
 
         Parameters
         ----------
-        state : Tuple[torch.tensor, torch.tensor]
-            composed of price tensor Xt and previous action wt_prev
-            price_tensor : torch.tensor
-                price tensor Xt comprised of close, high and low prices
-                dim = (batch_size, kfeatures, m_assets, window_size)
-                window_size pretains to last 50 trading prices
-            wt_prev : torch.tensor
+        price_tensor : torch.tensor
+            price tensor Xt comprised of close, high and low prices
+            dim = (batch_size, kfeatures, m_assets, window_size)
+            window_size pretains to last 50 trading prices
+        prev_weights : torch.tensor
+            previous action wt_prev
         current_weights : torch.tensor
             the current action wt
 
@@ -130,8 +131,6 @@ class Critic(nn.Module):
         torch.tensor
             _description_
         """
-        price_tensor = state[0]
-        prev_weights = state[1]
         x = self.model(price_tensor)
         prev_weights = prev_weights.unsqueeze(2).repeat(1, 1, 1).unsqueeze(1)
         x = torch.cat([x, prev_weights], dim=1)
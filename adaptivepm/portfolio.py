@@ -3,7 +3,8 @@ from __future__ import annotations
 import os
 import pickle
 from dataclasses import dataclass, field
-from typing import Dict, Iterator, List
+from functools import lru_cache
+from typing import Callable, Dict, Iterator, List
 
 import pandas as pd
 import torch
@@ -15,6 +16,51 @@ PATH_TO_PRICES_PICKLE = os.path.join(
 )
 
 
+def _transaction_remainder_factor(
+    wt: torch.Tensor, wt_prime: torch.Tensor, c: float, n_iter: int
+) -> torch.Tensor:
+    """Fixed-point iteration of formula 14 in https://arxiv.org/pdf/1706.10059
+    for the transaction remainder factor given wt and the end of period weights wt'
+    """
+    # get end of period cash position for each example in batch
+    wt_cash_prime = 1 - wt_prime.sum(dim=1)
+
+    # get cash position for portfolio weight at period t+1
+    wt_cash = 1 - wt.sum(dim=1)
+
+    # initial transaction remainder factor
+    ut_k = c * torch.abs(wt - wt_prime).sum(dim=1)
+
+    # loop invariant terms of formula 14
+    inv_denom = torch.reciprocal(1 - c * wt_cash)
+    const_term = 1 - c * wt_cash_prime
+    scale = c * (2 - c)
+
+    for _ in range(n_iter):
+        update_term = torch.relu(wt_prime - ut_k.unsqueeze(1) * wt).sum(dim=1)
+        ut_k = inv_denom * (const_term - scale * update_term)
+    return ut_k
+
+
+@lru_cache(maxsize=None)
+def _get_transaction_remainder_factor_kernel(device_type: str) -> Callable:
+    """Returns _transaction_remainder_factor specialized for the device type.
+    Shapes are fixed for a training run, so on cuda the function is compiled
+    without dynamic shapes; inductor support for mps is limited, hence it is
+    scripted there instead
+    """
+    if device_type == "cuda":
+        return torch.compile(
+            _transaction_remainder_factor,
+            fullgraph=True,
+            dynamic=False,
+            mode="reduce-overhead",
+        )
+    if device_type == "mps":
+        return torch.jit.script(_transaction_remainder_factor)
+    return _transaction_remainder_factor
+
+
 @dataclass
 class Portfolio:
     """Implements a Portfolio that holds CryptoCurrencies as Assets
@@ -33,6 +79,9 @@ class Portfolio:
     __assets: Dict[str, Asset] = field(init=False)
     m_assets: int = field(init=False, default=0)
     m_noncash_assets: int = field(init=False, default=0)
+    _tensors: Dict[str, torch.tensor] = field(
+        init=False, default_factory=dict, repr=False
+    )
 
     def __post_init__(self):
         self._load_pickle_object()
@@ -50,6 +99,24 @@ class Portfolio:
         self.m_noncash_assets = self.m_assets - 1
         self.n_samples = self.__prices["close"].shape[0]
 
+    def _get_tensor(self, key: str) -> torch.tensor:
+        """converts the prices of the portfolio's assets into a contiguous float32
+        tensor of shape (n_samples, m_assets) on the first call and caches it.
+        The tensor is pinned when an accelerator is present so that it can be
+        copied to the device asynchronously
+        """
+        tensor = self._tensors.get(key)
+        if tensor is None:
+            tensor = torch.from_numpy(
+                self.__prices[key][self.asset_names].to_numpy(
+                    dtype="float32", copy=True
+                )
+            ).contiguous()
+            if torch.cuda.is_available() or torch.mps.is_available():
+                tensor = tensor.pin_memory()
+            self._tensors[key] = tensor
+        return tensor
+
     def _load_pickle_object(self):
         with open(PATH_TO_PRICES_PICKLE, "rb") as f:
             self.__prices.update(pickle.load(f))
@@ -91,6 +158,21 @@ class Portfolio:
     def get_low_price(self):
         return self.__prices["low"]
 
+    def get_relative_price_tensor(self) -> torch.tensor:
+        return self._get_tensor("relative_price")
+
+    def get_open_tensor(self) -> torch.tensor:
+        return self._get_tensor("open")
+
+    def get_close_tensor(self) -> torch.tensor:
+        return self._get_tensor("close")
+
+    def get_high_tensor(self) -> torch.tensor:
+        return self._get_tensor("high")
+
+    def get_low_tensor(self) -> torch.tensor:
+        return self._get_tensor("low")
+
     def get_end_of_period_weights(self, yt: torch.tensor, wt_prev: torch.tensor):
         """Computes the wt' which is portfolio weight at the end of period t
         c.f formula 7 in https://arxiv.org/pdf/1706.10059
@@ -105,8 +187,8 @@ class Portfolio:
             portfolio weight at the beginning of previous period
             shape=(batch_size, m_noncash_assets)
         """
-        batch_size = wt_prev.shape[0]
-        wt_prime = (yt * wt_prev) / (yt * wt_prev).sum(dim=1).view(batch_size, 1)
+        y_w = yt * wt_prev
+        wt_prime = y_w / y_w.sum(dim=1, keepdim=True)
         return wt_prime
 
     def get_transacton_remainder_factor(
@@ -140,27 +222,42 @@ class Portfolio:
         number of iterations to compute the transaction remainder factor
         """
         wt_prime = self.get_end_of_period_weights(yt, wt_prev)
+        return self._get_transaction_remainder_factor(
+            wt, wt_prime, comission_rate, n_iter
+        )
 
-        # get end of period cash position for each example in batch
-        wt_cash_prime = 1 - wt_prime.sum(dim=1)
-
-        # get cash position for portfolio weight at period t+1
-        wt_cash = 1 - wt.sum(dim=1)
-
-        # initial transaction remainder factor
-        ut_k = comission_rate * torch.abs(wt - wt_prime).sum(dim=1)
-        c = comission_rate
-        for _ in range(n_iter):
-            update_term = torch.relu(wt_prime - ut_k.unsqueeze(1) * wt).sum(dim=1)
-            ut_k = (
-                1
-                / (1 - c * wt_cash)
-                * (1 - c * wt_cash_prime - c * (2 - c) * update_term)
-            )
-        return ut_k
+    def _get_transaction_remainder_factor(
+        self,
+        wt: torch.tensor,
+        wt_prime: torch.tensor,
+        comission_rate: float = 0.0026,
+        n_iter: int = 3,
+    ):
+        """Computes the transaction remainder factor given the end of period
+        weights wt', c.f get_transacton_remainder_factor
+        """
+        kernel = _get_transaction_remainder_factor_kernel(wt.device.type)
+        return kernel(wt, wt_prime, comission_rate, n_iter)
+
+    def warmup(self, batch_size: int, device: torch.device = "cpu"):
+        """Runs get_reward once on dummy inputs of the training shape so that the
+        transaction remainder factor kernel is compiled ahead of the training loop
+
+        Parameters
+        ----------
+        batch_size : int
+            number of examples in each minibatch
+        device : torch.device, default = "cpu"
+            device the rewards are computed on
+        """
+        shape = (batch_size, self.m_noncash_assets)
+        wt = torch.full(shape, 1 / self.m_assets, device=device)
+        self.get_reward(wt, torch.ones(shape, device=device), wt.clone())
 
     def get_reward(self, wt: torch.tensor, yt: torch.tensor, wt_prev: torch.tensor):
-        """_summary_
+        """Computes the per example immediate reward r_t / batch_size where
+        r_t = log(ut * yt . wt_prev), c.f https://arxiv.org/pdf/1706.10059
+        Summing the rewards over the batch gives the average logarithmic return
 
         Parameters
         ----------
@@ -171,14 +268,19 @@ class Portfolio:
         wt_prev : torch.tensor
             portfolio vector weight for beginning of period t
         """
-        batch_size = wt.shape[0]
-        ut = self.get_transacton_remainder_factor(wt, yt, wt_prev)
+        inv_batch_size = 1.0 / wt.shape[0]
+
+        # yt * wt_prev is shared by the portfolio return and wt' (formula 7)
+        y_w = yt * wt_prev
 
         # portfolio return before transaction cost
-        portfolio_return = (yt * wt_prev).sum(dim=1)
-        rt = torch.log(ut * portfolio_return)
+        portfolio_return = y_w.sum(dim=1)
+        wt_prime = y_w / portfolio_return.unsqueeze(1)
+        ut = self._get_transaction_remainder_factor(wt, wt_prime)
+        # log(ut * return) as a sum of logs avoids a temporary for the product
+        rt = torch.log(ut).add_(torch.log(portfolio_return))
 
-        return rt / batch_size
+        return rt.mul_(inv_batch_size)
 
 
 if __name__ == "__main__":
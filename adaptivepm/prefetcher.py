@@ -0,0 +1,48 @@
+from dataclasses import dataclass, field
+from typing import Iterable, Iterator, Optional, Tuple
+
+import torch
+
+
+@dataclass
+class Prefetcher:
+    """Wraps an iterable of batches of tensors and copies the next batch to the
+    device while the current batch is being consumed.
+    On cuda the copies are issued on a side stream, on other devices they are
+    issued ahead of time as non blocking copies on the default stream
+    """
+
+    batches: Iterable[Tuple[torch.tensor, ...]]
+    device: torch.device
+    stream: Optional[torch.cuda.Stream] = field(init=False, default=None)
+
+    def __post_init__(self):
+        self.device = torch.device(self.device)
+        if self.device.type == "cuda":
+            self.stream = torch.cuda.Stream(device=self.device)
+
+    def _to_device(self, batch: Tuple[torch.tensor, ...]) -> Tuple[torch.tensor, ...]:
+        return tuple(tensor.to(self.device, non_blocking=True) for tensor in batch)
+
+    def _preload(self, iterator: Iterator) -> Optional[Tuple[torch.tensor, ...]]:
+        batch = next(iterator, None)
+        if batch is None:
+            return None
+        if self.stream is None:
+            return self._to_device(batch)
+        with torch.cuda.stream(self.stream):
+            return self._to_device(batch)
+
+    def __iter__(self) -> Iterator[Tuple[torch.tensor, ...]]:
+        iterator = iter(self.batches)
+        next_batch = self._preload(iterator)
+        while next_batch is not None:
+            batch = next_batch
+            if self.stream is not None:
+                # wait for the side stream copies before the batch is used
+                current_stream = torch.cuda.current_stream(self.device)
+                current_stream.wait_stream(self.stream)
+                for tensor in batch:
+                    tensor.record_stream(current_stream)
+            next_batch = self._preload(iterator)
+            yield batch